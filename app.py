@@ -1,4 +1,8 @@
+import copy
 import functools
+import hashlib
+import io
+import types
 from pathlib import Path
 
 import streamlit as st
@@ -7,142 +11,175 @@ from st_aggrid.shared import JsCode
 from st_aggrid.grid_options_builder import GridOptionsBuilder
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 
 chart = functools.partial(st.plotly_chart, use_container_width=True)
-COMMON_ARGS = {
-    "color": "symbol",
-    "color_discrete_sequence": px.colors.sequential.Greens,
-    "hover_data": [
-        "account_name",
-        "percent_of_account",
-        "quantity",
-        "total_gain_loss_dollar",
-        "total_gain_loss_percent",
-    ],
+MONEY_CHARS = r"[$%]"
+MAX_PIE_SLICES = 20
+CELL_STYLE_JSCODE = JsCode(
+    """
+function(params) {
+    if (params.value > 0) {
+        return {
+            'color': 'white',
+            'backgroundColor': 'forestgreen'
+        }
+    } else if (params.value < 0) {
+        return {
+            'color': 'white',
+            'backgroundColor': 'crimson'
+        }
+    } else {
+        return {
+            'color': 'white',
+            'backgroundColor': 'slategray'
+        }
+    }
+};
+"""
+)
+HOLDING_AGGREGATIONS = {
+    "current_value": "sum",
+    "percent_of_account": "sum",
+    "quantity": "sum",
+    "total_gain_loss_dollar": "sum",
+    "cost_basis": "sum",
 }
+COMMON_ARGS = types.MappingProxyType(
+    {
+        "color": "symbol",
+        "color_discrete_sequence": tuple(px.colors.sequential.Greens),
+        "hover_data": (
+            "account_name",
+            "percent_of_account",
+            "quantity",
+            "total_gain_loss_dollar",
+            "total_gain_loss_percent",
+        ),
+    }
+)
+
+
+@st.experimental_singleton
+def read_file_bytes(path: str) -> bytes:
+    """
+    Read a bundled file once per server process.
+    The script module reruns on every interaction, so module constants would not persist.
+
+    Args:
+        path (str): path to a file shipped with the app
+
+    Returns:
+        bytes: file contents
+    """
+    return Path(path).read_bytes()
+
+
+@st.experimental_memo
+def load_csv(_data: bytes, csv_digest: str) -> pd.DataFrame:
+    """
+    Parse raw csv bytes into a dataframe.
+    Keyed on the file digest so reruns from widget changes skip parsing.
+    Columns that are blank in every row (e.g. Type in a 401k only export) are read as strings,
+    since arrow's null type cannot be filled.
+
+    Args:
+        _data (bytes): contents of a Fidelity csv export, not hashed by memo
+        csv_digest (str): digest of _data, used as the cache key
+
+    Returns:
+        pd.DataFrame: raw fidelity csv data
+    """
+    df = pd.read_csv(io.BytesIO(_data), dtype_backend="pyarrow")
+    all_null = [column for column, dtype in df.dtypes.items() if dtype == "null[pyarrow]"]
+    return df.astype({column: "string[pyarrow]" for column in all_null})
 
 
 @st.experimental_memo
-def clean_data(df: pd.DataFrame) -> pd.DataFrame:
+def clean_data(_df: pd.DataFrame, csv_digest: str) -> pd.DataFrame:
     """
     Take Raw Fidelity Dataframe and return usable dataframe.
     - snake_case headers
     - Include 401k by filling na type
-    - Drop Cash accounts and misc text
+    - Drop Cash accounts and misc text (rows missing holding columns)
     - Clean $ and % signs from values and convert to floats
+    - Store account_name and symbol as categoricals
 
     Args:
-        df (pd.DataFrame): Raw fidelity csv data
+        _df (pd.DataFrame): Raw fidelity csv data, not hashed by memo
+        csv_digest (str): digest of the csv _df was parsed from, used as the cache key
 
     Returns:
         pd.DataFrame: cleaned dataframe with features above
     """
-    df = df.copy()
-    df.columns = df.columns.str.lower().str.replace(" ", "_", regex=False).str.replace("/", "_", regex=False)
-
-    df.type = df.type.fillna("unknown")
-    df = df.dropna()
+    df = (
+        _df.rename(columns=lambda c: c.lower().replace(" ", "_").replace("/", "_"))
+        .fillna({"type": "unknown"})
+        .dropna(
+            subset=[
+                "account_name",
+                "symbol",
+                "quantity",
+                "last_price",
+                "current_value",
+                "cost_basis_per_share",
+            ]
+        )
+    )
 
     price_index = df.columns.get_loc("last_price")
     cost_basis_index = df.columns.get_loc("cost_basis_per_share")
-    df[df.columns[price_index : cost_basis_index + 1]] = df[
-        df.columns[price_index : cost_basis_index + 1]
-    ].transform(lambda s: s.str.replace("$", "", regex=False).str.replace("%", "", regex=False).astype(float))
+    money_columns = df.columns[price_index : cost_basis_index + 1]
+    df[money_columns] = df[money_columns].replace(MONEY_CHARS, "", regex=True).astype(float)
 
     quantity_index = df.columns.get_loc("quantity")
-    most_relevant_columns = df.columns[quantity_index : cost_basis_index + 1]
-    first_columns = df.columns[0:quantity_index]
-    last_columns = df.columns[cost_basis_index + 1 :]
-    df = df[[*most_relevant_columns, *first_columns, *last_columns]]
-    return df
+    columns = df.columns.tolist()
+    ordered_columns = [
+        *columns[quantity_index : cost_basis_index + 1],
+        *columns[:quantity_index],
+        *columns[cost_basis_index + 1 :],
+    ]
+    df = df.reindex(columns=ordered_columns)
+    return df.astype({"account_name": "category", "symbol": "category"})
 
 
 @st.experimental_memo
 def filter_data(
-    df: pd.DataFrame, account_selections: list[str], symbol_selections: list[str]
+    _df: pd.DataFrame,
+    csv_digest: str,
+    account_selections: list[str],
+    symbol_selections: list[str],
 ) -> pd.DataFrame:
     """
     Returns Dataframe with only accounts and symbols selected
 
     Args:
-        df (pd.DataFrame): clean fidelity csv data, including account_name and symbol columns
+        _df (pd.DataFrame): clean fidelity csv data with categorical account_name and symbol, not hashed
+        csv_digest (str): digest of the csv _df was cleaned from, cache key along with the selections
         account_selections (list[str]): list of account names to include
         symbol_selections (list[str]): list of symbols to include
 
     Returns:
         pd.DataFrame: data only for the given accounts and symbols
     """
-    df = df.copy()
-    df = df[
-        df.account_name.isin(account_selections) & df.symbol.isin(symbol_selections)
-    ]
+    account_codes = _df.account_name.cat.categories.get_indexer(account_selections)
+    symbol_codes = _df.symbol.cat.categories.get_indexer(symbol_selections)
+    mask = _df.account_name.cat.codes.isin(account_codes) & _df.symbol.cat.codes.isin(symbol_codes)
+    return _df.loc[mask]
 
-    return df
 
+@st.experimental_singleton
+def make_grid_options(df: pd.DataFrame) -> dict:
+    """
+    Build AgGrid options with gain/loss coloring, pagination, and pinned id columns.
+    Only column names and dtypes are read, so pass an empty frame to keep the cache key cheap.
 
-def main() -> None:
-    st.header("Fidelity Account Overview :moneybag: :dollar: :bar_chart:")
-
-    with st.expander("How to Use This"):
-        st.write(Path("README.md").read_text())
-
-    st.subheader("Upload your CSV from Fidelity")
-    uploaded_data = st.file_uploader(
-        "Drag and Drop or Click to Upload", type=".csv", accept_multiple_files=False
-    )
-
-    if uploaded_data is None:
-        st.info("Using example data. Upload a file above to use your own data!")
-        uploaded_data = open("example.csv", "r")
-    else:
-        st.success("Uploaded your file!")
-
-    df = pd.read_csv(uploaded_data)
-    with st.expander("Raw Dataframe"):
-        st.write(df)
-
-    df = clean_data(df)
-    with st.expander("Cleaned Data"):
-        st.write(df)
-
-    st.sidebar.subheader("Filter Displayed Accounts")
-
-    accounts = list(df.account_name.unique())
-    account_selections = st.sidebar.multiselect(
-        "Select Accounts to View", options=accounts, default=accounts
-    )
-    st.sidebar.subheader("Filter Displayed Tickers")
-
-    symbols = list(df.loc[df.account_name.isin(account_selections), "symbol"].unique())
-    symbol_selections = st.sidebar.multiselect(
-        "Select Ticker Symbols to View", options=symbols, default=symbols
-    )
+    Args:
+        df (pd.DataFrame): clean fidelity data, rows not needed
 
-    df = filter_data(df, account_selections, symbol_selections)
-    st.subheader("Selected Account and Ticker Data")
-    cellsytle_jscode = JsCode(
-        """
-    function(params) {
-        if (params.value > 0) {
-            return {
-                'color': 'white',
-                'backgroundColor': 'forestgreen'
-            }
-        } else if (params.value < 0) {
-            return {
-                'color': 'white',
-                'backgroundColor': 'crimson'
-            }
-        } else {
-            return {
-                'color': 'white',
-                'backgroundColor': 'slategray'
-            }
-        }
-    };
+    Returns:
+        dict: gridOptions for AgGrid, shared across sessions so copy before use
     """
-    )
-
     gb = GridOptionsBuilder.from_dataframe(df)
     gb.configure_columns(
         (
@@ -152,35 +189,128 @@ def main() -> None:
             "today's_gain_loss_dollar",
             "today's_gain_loss_percent",
         ),
-        cellStyle=cellsytle_jscode,
+        cellStyle=CELL_STYLE_JSCODE,
     )
     gb.configure_pagination()
     gb.configure_columns(("account_name", "symbol"), pinned=True)
-    gridOptions = gb.build()
+    return gb.build()
 
-    AgGrid(df, gridOptions=gridOptions, allow_unsafe_jscode=True)
 
-    def draw_bar(y_val: str) -> None:
-        fig = px.bar(df, y=y_val, x="symbol", **COMMON_ARGS)
-        fig.update_layout(barmode="stack", xaxis={"categoryorder": "total descending"})
-        chart(fig)
+def aggregate_holdings(df: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    """
+    Collapse holdings to one row per group with only the columns the charts read
 
-    account_plural = "s" if len(account_selections) > 1 else ""
-    st.subheader(f"Value of Account{account_plural}")
-    totals = df.groupby("account_name", as_index=False).sum()
-    if len(account_selections) > 1:
-        st.metric(
-            "Total of All Accounts",
-            f"${totals.current_value.sum():.2f}",
-            f"{totals.total_gain_loss_dollar.sum():.2f}",
-        )
-    for column, row in zip(st.columns(len(totals)), totals.itertuples()):
-        column.metric(
-            row.account_name,
-            f"${row.current_value:.2f}",
-            f"{row.total_gain_loss_dollar:.2f}",
-        )
+    Args:
+        df (pd.DataFrame): filtered fidelity data or an earlier aggregation of it
+        by (list[str]): columns to group on, e.g. account_name and symbol
+
+    Returns:
+        pd.DataFrame: summed values per group, total_gain_loss_percent weighted by cost basis
+            except for single row groups, which keep their own percent
+    """
+    summed = df.groupby(by, as_index=False, observed=True).agg(
+        **{column: (column, how) for column, how in HOLDING_AGGREGATIONS.items()},
+        holding_count=("current_value", "size"),
+        own_percent=("total_gain_loss_percent", "first"),
+    )
+    summed = with_gain_percent(summed)
+    summed["total_gain_loss_percent"] = summed.own_percent.where(
+        summed.holding_count == 1, summed.total_gain_loss_percent
+    )
+    return summed.drop(columns=["holding_count", "own_percent"])
+
+
+def with_gain_percent(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Set total_gain_loss_percent from summed dollars, since percents cannot be averaged
+
+    Args:
+        df (pd.DataFrame): aggregated holdings with total_gain_loss_dollar and cost_basis
+
+    Returns:
+        pd.DataFrame: df with total_gain_loss_percent as gain over cost basis, NaN without cost basis
+    """
+    cost_basis = df.cost_basis.where(df.cost_basis != 0)
+    return df.assign(total_gain_loss_percent=df.total_gain_loss_dollar / cost_basis * 100)
+
+
+def collapse_small_symbols(by_symbol: pd.DataFrame, limit: int) -> pd.DataFrame:
+    """
+    Keep the largest symbols by current value and fold the rest into one "Other" row
+
+    Args:
+        by_symbol (pd.DataFrame): holdings aggregated per symbol
+        limit (int): maximum number of rows to return, including "Other"
+
+    Returns:
+        pd.DataFrame: at most limit rows, largest current_value first
+    """
+    by_symbol = by_symbol.sort_values("current_value", ascending=False)
+    if len(by_symbol) <= limit:
+        return by_symbol
+    top, rest = by_symbol.iloc[: limit - 1], by_symbol.iloc[limit - 1 :]
+    other = pd.DataFrame([{"symbol": "Other", **rest.agg(HOLDING_AGGREGATIONS)}])
+    other = with_gain_percent(other)
+    return pd.concat([top.astype({"symbol": str}), other], ignore_index=True)
 
+
+@st.experimental_memo
+def make_symbol_bars(holdings: pd.DataFrame, by_symbol: pd.DataFrame) -> go.Figure:
+    """
+    Bars per symbol, one facet row each for value, gain, and gain percent.
+    Dollar rows stack one segment per account; percents can't be stacked, so that row has one
+    bar per symbol from the per symbol aggregate.
+
+    Args:
+        holdings (pd.DataFrame): filtered data aggregated per account and symbol
+        by_symbol (pd.DataFrame): filtered data aggregated per symbol
+
+    Returns:
+        go.Figure: single faceted bar chart with symbols ordered by value descending
+    """
+    symbol_order = by_symbol.sort_values("current_value", ascending=False).symbol.tolist()
+    id_vars = ["symbol", "account_name", "percent_of_account", "quantity"]
+    dollars = holdings.melt(
+        id_vars=id_vars,
+        value_vars=["current_value", "total_gain_loss_dollar"],
+        var_name="metric",
+        value_name="value",
+    )
+    percents = by_symbol.assign(account_name="All accounts").melt(
+        id_vars=id_vars,
+        value_vars=["total_gain_loss_percent"],
+        var_name="metric",
+        value_name="value",
+    )
+    metrics = pd.concat([dollars, percents], ignore_index=True).astype(
+        {"symbol": str, "account_name": str}
+    )
+    fig = px.bar(
+        metrics,
+        y="value",
+        x="symbol",
+        facet_row="metric",
+        category_orders={"symbol": symbol_order},
+        height=900,
+        **{**COMMON_ARGS, "hover_data": ("account_name", "percent_of_account", "quantity")},
+    )
+    fig.update_layout(barmode="stack")
+    fig.update_yaxes(matches=None, title_text="")
+    fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+    return fig
+
+
+@st.experimental_memo
+def make_account_bar(totals: pd.DataFrame) -> go.Figure:
+    """
+    Horizontal bar of current value per account
+
+    Args:
+        totals (pd.DataFrame): per account sums, including account_name and current_value
+
+    Returns:
+        go.Figure: bar chart ordered by total descending
+    """
     fig = px.bar(
         totals,
         y="account_name",
@@ -189,27 +319,148 @@ def main() -> None:
         color_discrete_sequence=px.colors.sequential.Greens,
     )
     fig.update_layout(barmode="stack", xaxis={"categoryorder": "total descending"})
-    chart(fig)
+    return fig
 
-    st.subheader("Value of each Symbol")
-    draw_bar("current_value")
 
-    st.subheader("Value of each Symbol per Account")
+@st.experimental_memo
+def make_sunburst(holdings: pd.DataFrame) -> go.Figure:
+    """
+    Sunburst of current value by account then symbol
+
+    Args:
+        holdings (pd.DataFrame): filtered data aggregated per account and symbol
+
+    Returns:
+        go.Figure: sunburst chart
+    """
+    # plotly groups the path without observed=True, so categoricals would add empty nodes
+    path_df = holdings.astype({"account_name": str, "symbol": str})
     fig = px.sunburst(
-        df, path=["account_name", "symbol"], values="current_value", **COMMON_ARGS
+        path_df, path=["account_name", "symbol"], values="current_value", **COMMON_ARGS
     )
     fig.update_layout(margin=dict(t=0, b=0, l=0, r=0))
-    chart(fig)
+    return fig
 
-    st.subheader("Value of each Symbol")
-    fig = px.pie(df, values="current_value", names="symbol", **COMMON_ARGS)
+
+@st.experimental_memo
+def make_pie(by_symbol: pd.DataFrame) -> go.Figure:
+    """
+    Pie of current value by symbol, with the smallest symbols grouped as "Other"
+
+    Args:
+        by_symbol (pd.DataFrame): filtered data aggregated per symbol
+
+    Returns:
+        go.Figure: pie chart
+    """
+    by_symbol = collapse_small_symbols(by_symbol, MAX_PIE_SLICES)
+    pie_args = {
+        **COMMON_ARGS,
+        "hover_data": ["quantity", "total_gain_loss_dollar", "total_gain_loss_percent"],
+    }
+    fig = px.pie(by_symbol, values="current_value", names="symbol", **pie_args)
     fig.update_layout(margin=dict(t=0, b=0, l=0, r=0))
-    chart(fig)
+    return fig
+
+
+def render_selection(
+    df: pd.DataFrame,
+    csv_digest: str,
+    account_selections: list[str],
+    symbol_selections: list[str],
+) -> None:
+    """
+    Draw the grid, account metrics, and charts for the selected accounts and symbols.
+    Everything upstream of this is memoized, so a filter change only recomputes from here.
+
+    Args:
+        df (pd.DataFrame): clean fidelity csv data
+        csv_digest (str): digest of the csv df was cleaned from
+        account_selections (list[str]): list of account names to include
+        symbol_selections (list[str]): list of symbols to include
+    """
+    df = filter_data(df, csv_digest, account_selections, symbol_selections)
+    st.subheader("Selected Account and Ticker Data")
+    # AgGrid edits gridOptions in place, so never hand it the shared cached dict
+    grid_options = copy.deepcopy(make_grid_options(df.head(0)))
+    AgGrid(df, gridOptions=grid_options, allow_unsafe_jscode=True)
+
+    account_plural = "s" if len(account_selections) > 1 else ""
+    st.subheader(f"Value of Account{account_plural}")
+    holdings = aggregate_holdings(df, ["account_name", "symbol"])
+    by_symbol = aggregate_holdings(holdings, ["symbol"])
+    totals = holdings.groupby("account_name", as_index=False, observed=True)[
+        ["current_value", "total_gain_loss_dollar"]
+    ].sum()
+    if len(account_selections) > 1:
+        st.metric(
+            "Total of All Accounts",
+            f"${totals.current_value.sum():.2f}",
+            f"{totals.total_gain_loss_dollar.sum():.2f}",
+        )
+    names = totals.account_name.tolist()
+    values = totals.current_value.map("${:.2f}".format).tolist()
+    deltas = totals.total_gain_loss_dollar.map("{:.2f}".format).tolist()
+    for column, name, value, delta in zip(st.columns(len(totals)), names, values, deltas):
+        column.metric(name, value, delta)
+
+    chart(make_account_bar(totals))
+
+    st.subheader("Value and Gains of each Symbol")
+    chart(make_symbol_bars(holdings, by_symbol))
+
+    st.subheader("Value of each Symbol per Account")
+    chart(make_sunburst(holdings))
+
+    st.subheader("Value of each Symbol")
+    chart(make_pie(by_symbol))
+
+
+def main() -> None:
+    st.header("Fidelity Account Overview :moneybag: :dollar: :bar_chart:")
+
+    with st.expander("How to Use This"):
+        st.write(read_file_bytes("README.md").decode("utf-8"))
+
+    st.subheader("Upload your CSV from Fidelity")
+    uploaded_data = st.file_uploader(
+        "Drag and Drop or Click to Upload", type=".csv", accept_multiple_files=False
+    )
+
+    if uploaded_data is None:
+        st.info("Using example data. Upload a file above to use your own data!")
+        csv_bytes = read_file_bytes("example.csv")
+    else:
+        st.success("Uploaded your file!")
+        csv_bytes = uploaded_data.getvalue()
+
+    csv_digest = hashlib.md5(csv_bytes, usedforsecurity=False).hexdigest()
+    df = load_csv(csv_bytes, csv_digest)
+    with st.expander("Raw Dataframe"):
+        st.write(df)
+
+    df = clean_data(df, csv_digest)
+    with st.expander("Cleaned Data"):
+        st.write(df)
+
+    st.sidebar.subheader("Filter Displayed Accounts")
+
+    accounts = df.account_name.cat.categories.tolist()
+    account_selections = st.sidebar.multiselect(
+        "Select Accounts to View", options=accounts, default=accounts
+    )
+    st.sidebar.subheader("Filter Displayed Tickers")
+
+    symbols = (
+        df.loc[df.account_name.isin(account_selections), "symbol"]
+        .cat.remove_unused_categories()
+        .cat.categories.tolist()
+    )
+    symbol_selections = st.sidebar.multiselect(
+        "Select Ticker Symbols to View", options=symbols, default=symbols
+    )
 
-    st.subheader("Total Value gained each Symbol")
-    draw_bar("total_gain_loss_dollar")
-    st.subheader("Total Percent Value gained each Symbol")
-    draw_bar("total_gain_loss_percent")
+    render_selection(df, csv_digest, account_selections, symbol_selections)
 
 
 if __name__ == "__main__":